@@ -0,0 +1,119 @@
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from dungeon_server import DungeonClient
+from fuzz_dung import build_sample_dungeon
+
+#
+# Load test for dungeon_server.py: concurrent clients send a mix of queries and the
+# requests/sec and round trip latencies are reported. Without --unix/--port a server is
+# started on a temporary Unix socket and fed the built in sample dungeon.
+#
+
+def make_requests(path, maps, rng, count):
+    requests = []
+    for _ in range(count):
+        map_index = rng.randrange(len(maps))
+        w = maps[map_index]['Width']+1
+        h = maps[map_index]['Height']+1
+        op = rng.choice(('header', 'maps', 'tiles', 'square', 'square', 'thing'))
+        request = {'op': op, 'path': path}
+        if op == 'tiles':
+            x0, y0 = rng.randrange(w), rng.randrange(h)
+            request.update(map=map_index, x0=x0, y0=y0, x1=x0 + 8, y1=y0 + 8)
+        elif op == 'square':
+            request.update(map=map_index, x=rng.randrange(w), y=rng.randrange(h))
+        elif op == 'thing':
+            request.update(category='doors', index=0)
+        requests.append(request)
+    return requests
+
+async def run_client(connect, path, maps, seed, round_trips, batch_size, latencies):
+    rng = random.Random(seed)
+    client = await DungeonClient.connect(**connect)
+    try:
+        for _ in range(round_trips):
+            requests = make_requests(path, maps, rng, batch_size)
+            start = time.perf_counter()
+            if batch_size == 1:
+                await client.send(requests[0])
+            else:
+                await client.send(requests)
+            latencies.append(time.perf_counter() - start)
+    finally:
+        await client.close()
+
+async def load_test(connect, path, clients, round_trips, batch_size):
+    client = await DungeonClient.connect(**connect)
+    maps = await client.query({'op': 'maps', 'path': path})
+    await client.close()
+
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*(run_client(connect, path, maps, seed, round_trips, batch_size, latencies)
+                           for seed in range(clients)))
+    total = time.perf_counter() - start
+
+    latencies.sort()
+    requests = len(latencies) * batch_size
+    print(f"{clients} clients, {len(latencies)} round trips of {batch_size} requests in {total:.2f}s")
+    print(f"  {requests / total:,.0f} requests/sec, {len(latencies) / total:,.0f} round trips/sec")
+    for percentile in (50, 90, 99):
+        latency = latencies[min(len(latencies) - 1, len(latencies) * percentile // 100)]
+        print(f"  p{percentile} round trip: {latency * 1000:.3f}ms")
+    print(f"  max round trip: {latencies[-1] * 1000:.3f}ms")
+
+async def wait_for_server(connect, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            client = await DungeonClient.connect(**connect)
+            await client.query({'op': 'ping'})
+            await client.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.05)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure requests/sec of dungeon_server.py")
+    parser.add_argument('filename', nargs='?', help="Dungeon.dat to query (default: built in sample)")
+    parser.add_argument('--unix', help="connect to a running server on this Unix socket")
+    parser.add_argument('--host', default='127.0.0.1', help="TCP address of a running server")
+    parser.add_argument('--port', type=int, help="connect to a running server on this TCP port")
+    parser.add_argument('--clients', type=int, default=16, help="concurrent clients")
+    parser.add_argument('--round-trips', type=int, default=500, help="round trips per client")
+    parser.add_argument('--batch', type=int, default=1, help="requests per round trip")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = args.filename
+        if path is None:
+            path = os.path.join(tmpdir, 'SAMPLE.DAT')
+            with open(path, 'wb') as file:
+                file.write(build_sample_dungeon())
+        path = os.path.abspath(path)
+
+        server = None
+        if args.unix:
+            connect = {'unix': args.unix}
+        elif args.port:
+            connect = {'host': args.host, 'port': args.port}
+        else:
+            connect = {'unix': os.path.join(tmpdir, 'dungeon.sock')}
+            server_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dungeon_server.py')
+            server = subprocess.Popen([sys.executable, server_script, '--unix', connect['unix'], path])
+        try:
+            asyncio.run(wait_for_server(connect))
+            asyncio.run(load_test(connect, path, args.clients, args.round_trips, args.batch))
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
@@ -0,0 +1,335 @@
+import argparse
+import asyncio
+import ipaddress
+import json
+import os
+import sys
+from collections import OrderedDict
+from stat import S_ISREG
+
+from uncompress_dung import LoadDungeon, DungeonFormatError
+
+#
+# Long running query service that keeps parsed Dungeon.dat files in memory.
+#
+# The protocol is one JSON document per line, over a Unix socket or localhost TCP. A request is an
+# object like {"id": 1, "op": "square", "path": "DUNGEON.DAT", "map": 0, "x": 3, "y": 4}. A list
+# of requests is a batch and is answered by a list of responses in the same order. Every response
+# is {"id": ..., "result": ...} or {"id": ..., "error": {"type": ..., "message": ...}}.
+#
+# Operations:
+#   ping                                  -> "pong"
+#   header   path                         -> file header
+#   maps     path [map]                   -> all map infos, or the one of map index `map`
+#   tiles    path map [x0 y0 x1 y1]       -> rows of raw square bytes, y0 <= y < y1, x0 <= x < x1
+#   square   path map x y                 -> things on a square, following their Next links
+#   thing    path category index         -> one thing, category is a name ("doors") or 0-15
+#   evict    [path]                       -> drop one or all dungeons from the cache
+#   stats                                 -> cache content and counters
+#
+# Dungeons are loaded with strict=True on first use and reloaded when the file changes on disk.
+# The file is checked once per line, so all requests of a batch see the same dungeon.
+# A file that fails to parse is remembered as failed until it changes. Paths that are not regular
+# files, or are larger than max_size, are refused without being opened.
+#
+
+def is_loopback(host):
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+class DungeonCache:
+    def __init__(self, capacity=16, max_size=1 << 20):
+        self.capacity = capacity
+        self.max_size = max_size       # bigger files are refused, dungeons are tens of KB
+        # abspath -> (mtime_ns, size, LoadDungeon or the DungeonFormatError it failed with)
+        self.dungeons = OrderedDict()
+        self.loading = {}              # (abspath, mtime_ns, size) -> Future of a load in progress
+        self.hits = 0
+        self.misses = 0
+
+    def _load(self, path):
+        # Returns the stat of the file that was actually parsed, it may be newer than the
+        # one the load was started for. O_NONBLOCK keeps open() from hanging if the path
+        # was replaced by a FIFO after get() checked it.
+        fd = os.open(path, os.O_RDONLY | getattr(os, 'O_NONBLOCK', 0))
+        with os.fdopen(fd, 'rb') as file:
+            stat = os.fstat(fd)
+            self._check_file(path, stat)
+            buffer = file.read(self.max_size + 1)
+        if len(buffer) > self.max_size:
+            raise ValueError(f"{path} is larger than {self.max_size} bytes")
+        dungeon = LoadDungeon()
+        try:
+            dungeon.load_buffer(buffer, strict=True)
+        except DungeonFormatError as error:
+            return stat, error
+        return stat, dungeon
+
+    def _check_file(self, path, stat):
+        if not S_ISREG(stat.st_mode):
+            raise ValueError(f"{path} is not a regular file")
+        if stat.st_size > self.max_size:
+            raise ValueError(f"{path} is larger than {self.max_size} bytes")
+
+    async def get(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        self._check_file(path, stat)
+        entry = self.dungeons.get(path)
+        if entry is not None and entry[:2] == (stat.st_mtime_ns, stat.st_size):
+            self.hits += 1
+            self.dungeons.move_to_end(path)
+            dungeon = entry[2]
+        else:
+            # Several clients asking for the same version of a file share one load
+            key = (path, stat.st_mtime_ns, stat.st_size)
+            if key not in self.loading:
+                self.misses += 1
+                loop = asyncio.get_running_loop()
+                self.loading[key] = loop.run_in_executor(None, self._load, path)
+            future = self.loading[key]
+            try:
+                stat, dungeon = await future
+            finally:
+                if self.loading.get(key) is future:
+                    del self.loading[key]
+
+            self.dungeons[path] = (stat.st_mtime_ns, stat.st_size, dungeon)
+            self.dungeons.move_to_end(path)
+            while len(self.dungeons) > self.capacity:
+                self.dungeons.popitem(last=False)
+
+        # A file that failed to parse is not parsed again until it changes
+        if isinstance(dungeon, DungeonFormatError):
+            raise dungeon.with_traceback(None)
+        return dungeon
+
+    def evict(self, path=None):
+        if path is None:
+            count = len(self.dungeons)
+            self.dungeons.clear()
+            return count
+        return 1 if self.dungeons.pop(os.path.abspath(path), None) else 0
+
+class DungeonServer:
+    def __init__(self, cache):
+        self.cache = cache
+        self.requests = 0
+        self.ops = {
+            'header': self.op_header,
+            'maps':   self.op_maps,
+            'tiles':  self.op_tiles,
+            'square': self.op_square,
+            'thing':  self.op_thing,
+        }
+
+    def _map(self, dungeon, request):
+        map_index = request['map']
+        if not 0 <= map_index < len(dungeon.maps):
+            raise IndexError(f"Map {map_index} out of range, dungeon has {len(dungeon.maps)} maps")
+        return map_index, dungeon.maps[map_index]
+
+    def op_header(self, dungeon, request):
+        return dungeon.hdr
+
+    def op_maps(self, dungeon, request):
+        if 'map' in request:
+            return self._map(dungeon, request)[1]
+        return dungeon.maps
+
+    def op_tiles(self, dungeon, request):
+        map_index, map_info = self._map(dungeon, request)
+        w = (map_info['Width']+1)
+        h = (map_info['Height']+1)
+        x0 = max(request.get('x0', 0), 0)
+        y0 = max(request.get('y0', 0), 0)
+        x1 = min(request.get('x1', w), w)
+        y1 = min(request.get('y1', h), h)
+        # Squares are stored column by column
+        start = map_info['RawMapDataByteOffset']
+        columns = [dungeon.tile_data[start + x * h + y0:start + x * h + y1] for x in range(x0, x1)]
+        return [[column[y] for column in columns] for y in range(y1 - y0)]
+
+    def op_square(self, dungeon, request):
+        map_index, map_info = self._map(dungeon, request)
+        return dungeon.get_square_things(map_index, request['x'], request['y'])
+
+    def op_thing(self, dungeon, request):
+        category = request['category']
+        if isinstance(category, str):
+            if category not in LoadDungeon.THING_SECTIONS:
+                raise ValueError(f"Unknown thing category {category!r}, "
+                                 f"valid are {', '.join(LoadDungeon.THING_SECTIONS)} or 0-15")
+            category = LoadDungeon.THING_SECTIONS.index(category)
+        if not 0 <= category < len(dungeon.thinglist):
+            raise IndexError(f"Thing category {category} out of range")
+        things = dungeon.thinglist[category]
+        index = request['index']
+        if not things or not 0 <= index < len(things):
+            raise IndexError(f"Thing {index} out of range for category {category}")
+        return things[index]
+
+    async def handle_request(self, request, dungeons):
+        # dungeons maps the paths already looked up for the current line to their dungeon,
+        # or to the error loading it failed with
+        self.requests += 1
+        request_id = request.get('id') if isinstance(request, dict) else None
+        try:
+            if not isinstance(request, dict):
+                raise ValueError("Request must be a JSON object")
+            op = request.get('op')
+            if op == 'ping':
+                result = 'pong'
+            elif op == 'evict':
+                result = self.cache.evict(request.get('path'))
+            elif op == 'stats':
+                result = {
+                    'dungeons': [path for path, entry in self.cache.dungeons.items()
+                                 if not isinstance(entry[2], DungeonFormatError)],
+                    'failed':   [path for path, entry in self.cache.dungeons.items()
+                                 if isinstance(entry[2], DungeonFormatError)],
+                    'capacity': self.cache.capacity,
+                    'hits':     self.cache.hits,
+                    'misses':   self.cache.misses,
+                    'requests': self.requests,
+                }
+            elif op in self.ops:
+                path = request['path']
+                dungeon = dungeons.get(path)
+                if dungeon is None:
+                    try:
+                        dungeon = await self.cache.get(path)
+                    except (DungeonFormatError, OSError, ValueError) as error:
+                        dungeon = error
+                    dungeons[path] = dungeon
+                if isinstance(dungeon, Exception):
+                    raise dungeon.with_traceback(None)
+                result = self.ops[op](dungeon, request)
+            else:
+                raise ValueError(f"Unknown op {op!r}")
+        except DungeonFormatError as error:
+            return {'id': request_id, 'error': {'type': type(error).__name__, 'message': str(error),
+                                                'section': error.section, 'offset': error.offset}}
+        except (KeyError, ValueError, IndexError, TypeError, OSError) as error:
+            return {'id': request_id, 'error': {'type': type(error).__name__, 'message': str(error)}}
+        return {'id': request_id, 'result': result}
+
+    async def handle_client(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                except ValueError as error:
+                    response = {'id': None, 'error': {'type': 'JSONDecodeError', 'message': str(error)}}
+                else:
+                    if isinstance(request, list):
+                        dungeons = {}
+                        response = [await self.handle_request(item, dungeons) for item in request]
+                    else:
+                        response = await self.handle_request(request, {})
+                writer.write(json.dumps(response, separators=(',', ':')).encode() + b'\n')
+                await writer.drain()
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, unix=None, host='127.0.0.1', port=8765, allow_remote=False):
+        # There is no authentication and clients name any file the server can read, so TCP
+        # stays on loopback unless explicitly allowed
+        if not unix and not allow_remote and not is_loopback(host):
+            raise ValueError(f"Refusing to listen on non-loopback address {host}")
+        # Lines up to 16MB so large batches fit
+        if unix:
+            server = await asyncio.start_unix_server(self.handle_client, unix, limit=1 << 24)
+        else:
+            server = await asyncio.start_server(self.handle_client, host, port, limit=1 << 24)
+        async with server:
+            await server.serve_forever()
+
+#
+# Client for tools talking to the server, e.g.
+#   client = await DungeonClient.connect(unix="/tmp/dungeon.sock")
+#   hdr = await client.query({'op': 'header', 'path': 'DUNGEON.DAT'})
+#   answers = await client.batch([{'op': 'square', ...}, {'op': 'thing', ...}])
+#
+
+class DungeonQueryError(Exception):
+    def __init__(self, error):
+        self.error = error
+        super().__init__(f"{error['type']}: {error['message']}")
+
+class DungeonClient:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def connect(cls, unix=None, host='127.0.0.1', port=8765):
+        if unix:
+            reader, writer = await asyncio.open_unix_connection(unix, limit=1 << 24)
+        else:
+            reader, writer = await asyncio.open_connection(host, port, limit=1 << 24)
+        return cls(reader, writer)
+
+    async def send(self, request):
+        # Returns the raw response (or list of responses for a batch)
+        self.writer.write(json.dumps(request, separators=(',', ':')).encode() + b'\n')
+        await self.writer.drain()
+        return json.loads(await self.reader.readline())
+
+    async def query(self, request):
+        response = await self.send(request)
+        if 'error' in response:
+            raise DungeonQueryError(response['error'])
+        return response['result']
+
+    async def batch(self, requests):
+        # Results in request order, a failed request gives a DungeonQueryError in its place
+        return [DungeonQueryError(response['error']) if 'error' in response else response['result']
+                for response in await self.send(requests)]
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve queries over parsed Dungeon.dat files")
+    parser.add_argument('--unix', help="listen on this Unix socket instead of TCP")
+    parser.add_argument('--host', default='127.0.0.1', help="TCP loopback address (default: 127.0.0.1)")
+    parser.add_argument('--allow-remote', action='store_true',
+                        help="allow a non-loopback --host, the server has no authentication")
+    parser.add_argument('--port', type=int, default=8765, help="TCP port (default: 8765)")
+    parser.add_argument('--cache', type=int, default=16, help="number of dungeons kept in memory")
+    parser.add_argument('--max-size', type=int, default=1 << 20, help="largest file accepted in bytes")
+    parser.add_argument('preload', nargs='*', help="Dungeon.dat files to load at startup")
+    args = parser.parse_args()
+    if not args.unix and not args.allow_remote and not is_loopback(args.host):
+        parser.error(f"--host {args.host} is not a loopback address, pass --allow-remote to use it")
+
+    async def main():
+        server = DungeonServer(DungeonCache(args.cache, args.max_size))
+        loaded = 0
+        for path in args.preload:
+            try:
+                await server.cache.get(path)
+                loaded += 1
+            except (DungeonFormatError, OSError, ValueError) as error:
+                print(f"Could not load {path}: {error}", file=sys.stderr)
+        where = args.unix or f"{args.host}:{args.port}"
+        print(f"Serving {loaded} dungeons on {where}", file=sys.stderr)
+        await server.serve(args.unix, args.host, args.port, args.allow_remote)
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
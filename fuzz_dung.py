@@ -0,0 +1,137 @@
+import argparse
+import random
+import struct
+import time
+from collections import Counter
+
+from uncompress_dung import LoadDungeon, DungeonFormatError
+
+#
+# Fuzz the strict parser of uncompress_dung.py with truncated and mutated Dungeon.dat files
+# and report how long the worst input took to parse (or to be rejected).
+#
+
+def build_sample_dungeon():
+    # Small but complete uncompressed dungeon: two maps, every square with things
+    # flagged in the tiles and pointing into the square first thing list
+    sizes = [(15, 15), (7, 11)]
+    thing_count = [2, 1, 3, 2, 2, 4, 3, 1, 2, 1, 2, 0, 0, 0, 1, 1]
+    thing_types = [thing_type for thing_type, count in enumerate(thing_count) for _ in range(count)]
+    thing_indices = [index for count in thing_count for index in range(count)]
+    maps = b''
+    tile_data = b''
+    columns = []
+    square_first_things = []
+    for level, (width, height) in enumerate(sizes):
+        maps += struct.pack('>HHHBBHHHH', len(tile_data), 0, 0, 0, level,
+                            (height << 11) | (width << 6) | level, 0x2312, 0x1222, 0x1000)
+        for x in range(width+1):
+            columns.append(len(square_first_things))
+            for y in range(height+1):
+                square = ((x * 7 + y * 3 + level) % 6) << 5
+                if (x + y + level) % 9 == 0:
+                    square |= 0x10
+                    thing = len(square_first_things) % len(thing_types)
+                    square_first_things.append((thing_types[thing] << 10) | thing_indices[thing])
+                tile_data += bytes([square])
+        tile_data += bytes([6, 10, 33, 4, 2, 8, 4, 8])
+    text_data_word_count = 16
+    header = struct.pack('>HHBxHHH' + ('H' * 16), 0x0063, len(tile_data), len(sizes),
+                         text_data_word_count, 0, len(square_first_things), *thing_count)
+    things = b''
+    for thing_type, (count, size) in enumerate(zip(thing_count, LoadDungeon.THING_SIZES)):
+        for index in range(count):
+            # The first door links to the second one, every other thing ends its list
+            next_thing = 1 if (thing_type, index) == (0, 0) else 0xFFFE
+            things += struct.pack('>H', next_thing) + bytes(range(index, index + size - 2))
+    return (header + maps + struct.pack(f'>{len(columns)}H', *columns)
+            + struct.pack(f'>{len(square_first_things)}H', *square_first_things)
+            + b'\x41\x42' * text_data_word_count + things + tile_data + b'\x12\x34')
+
+def compress_dungeon(buffer):
+    # Inverse of LoadDungeon.decompress_dungeon: 3 bit codes for the 4 most common bytes,
+    # 6 bit codes for the next 16 and 10 bit codes for everything else
+    common = [byte for byte, _ in Counter(buffer).most_common(20)]
+    common += [byte for byte in range(256) if byte not in common][:20 - len(common)]
+    most_common, less_common = common[:4], common[4:20]
+    bits = ''
+    for byte in buffer:
+        if byte in most_common:
+            bits += '0' + format(most_common.index(byte), '02b')
+        elif byte in less_common:
+            bits += '10' + format(less_common.index(byte), '04b')
+        else:
+            bits += '11' + format(byte, '08b')
+    bits += '0' * (-len(bits) % 8)
+    data = bytes(int(bits[i:i + 8], 2) for i in range(0, len(bits), 8))
+    return struct.pack('>HlH', 0x8104, len(buffer), 0) + bytes(most_common + less_common) + data
+
+def build_corpus(seed_buffer, iterations, rng):
+    corpus = []
+    # Every truncation point
+    for length in range(len(seed_buffer)):
+        corpus.append(('truncated', seed_buffer[:length]))
+    # Random byte flips
+    for _ in range(iterations):
+        mutated = bytearray(seed_buffer)
+        for _ in range(rng.randint(1, 8)):
+            mutated[rng.randrange(len(mutated))] = rng.randrange(256)
+        corpus.append(('mutated', bytes(mutated)))
+    # Out of range counts in the file and dungeon headers
+    for value in (0x7fffffff, -1, len(seed_buffer) * 4):
+        corpus.append(('byte_count', seed_buffer[:2] + struct.pack('>l', value) + seed_buffer[6:]))
+    for _ in range(iterations // 10):
+        mutated = bytearray(seed_buffer)
+        offset = rng.randrange(0, min(len(mutated), 52) - 1)
+        mutated[offset:offset + 2] = b'\xff\xff'
+        corpus.append(('header_count', bytes(mutated)))
+    return corpus
+
+def run_corpus(corpus):
+    results = Counter()
+    unexpected = []
+    worst = (0.0, None)
+    for kind, data in corpus:
+        dungeon = LoadDungeon()
+        start = time.perf_counter()
+        try:
+            dungeon.load_buffer(data, strict=True)
+            results[(kind, 'ok')] += 1
+        except DungeonFormatError as error:
+            results[(kind, type(error).__name__, error.section)] += 1
+        except Exception as error:
+            unexpected.append((kind, len(data), repr(error)))
+        elapsed = time.perf_counter() - start
+        if elapsed > worst[0]:
+            worst = (elapsed, (kind, len(data)))
+    return results, unexpected, worst
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fuzz the strict Dungeon.dat parser")
+    parser.add_argument('filename', nargs='?', help="seed Dungeon.dat (default: built in sample)")
+    parser.add_argument('--iterations', type=int, default=2000, help="number of random mutations")
+    parser.add_argument('--seed', type=int, default=0, help="random seed")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    if args.filename:
+        with open(args.filename, 'rb') as file:
+            seeds = [file.read()]
+    else:
+        sample = build_sample_dungeon()
+        seeds = [sample, compress_dungeon(sample)]
+
+    failed = False
+    for seed_buffer in seeds:
+        corpus = build_corpus(seed_buffer, args.iterations, rng)
+        start = time.perf_counter()
+        results, unexpected, worst = run_corpus(corpus)
+        total = time.perf_counter() - start
+        print(f"Seed of {len(seed_buffer)} bytes: {len(corpus)} inputs in {total:.2f}s, "
+              f"worst {worst[0] * 1000:.2f}ms for {worst[1]}")
+        for key, count in sorted(results.items(), key=lambda item: str(item[0])):
+            print(f"  {count:6d}  {' / '.join(str(part) for part in key)}")
+        for kind, length, error in unexpected:
+            print(f"  UNEXPECTED {kind} ({length} bytes): {error}")
+        failed = failed or bool(unexpected)
+    raise SystemExit(1 if failed else 0)
@@ -1,14 +1,34 @@
+import math
 import struct
 
+#
+# Errors raised while parsing a Dungeon.dat file. Both derive from ValueError, so
+# existing callers catching ValueError keep working.
+# offset is a position in the file, except for errors found after a compressed file was
+# decompressed: those have decompressed=True and offset is a position in the decompressed data.
+#
+
+class DungeonFormatError(ValueError):
+    def __init__(self, message, section=None, offset=None, decompressed=False):
+        self.section = section
+        self.offset = offset
+        self.decompressed = decompressed
+        super().__init__(f"{message} (section: {section}, offset: {offset})")
+
+class DungeonTruncatedError(DungeonFormatError):
+    pass
+
 class BufferReader:
     def __init__(self, buffer):
         self.buffer = buffer
         self.position = 0
 
-    def read_data(self, size):
+    def read_data(self, size, section=None):
         # Check if the request exceeds the buffer's bounds
         if self.position + size > len(self.buffer):
-            raise ValueError("Attempt to read beyond buffer length")
+            raise DungeonTruncatedError(
+                f"Attempt to read {size} bytes beyond buffer length {len(self.buffer)}",
+                section, self.position)
         
         # Read `size` bytes from the current position
         data = self.buffer[self.position:self.position + size]
@@ -22,12 +42,47 @@ class BufferReader:
 #
 
 class LoadDungeon:
-    def decompress_dungeon(self, compressed_buffer, decompressed_byte_count):
+    # Size in bytes of one entry of each of the 16 thing lists, and the section name used in errors
+    THING_SIZES = (4, 6, 4, 8, 16, 4, 4, 4, 4, 8, 4, 0, 0, 0, 8, 4)
+    THING_SECTIONS = ('doors', 'teleporters', 'textstrings', 'sensors', 'creatures', 'weapons',
+                      'armors', 'scrolls', 'potions', 'containers', 'junk', 'unused11',
+                      'unused12', 'unused13', 'projectiles', 'explosions')
+
+    # Print progress while loading, load()/load_buffer() turn this off in strict mode
+    verbose = True
+
+    def _progress(self, *args):
+        if self.verbose:
+            print(*args)
+
+    def decompress_dungeon(self, compressed_buffer, decompressed_byte_count, strict=False):
         # Initialize variables
         byte_count = 0
         bit_buffer = 0
         bits_in_buffer_count = 0
         
+        # compressed_buffer starts after the 8 byte file header, errors report file positions,
+        # for truncation the end of the file
+        end_offset = 8 + len(compressed_buffer)
+        if strict:
+            # Every byte needs at least 3 bits, so reject counts the input can not possibly hold
+            # before allocating or decoding anything. This bounds the work to the input length.
+            if decompressed_byte_count < 0:
+                raise DungeonFormatError(f"Invalid decompressed byte count {decompressed_byte_count}",
+                                         'compressed_header', 2)
+            needed = 20 + math.ceil(decompressed_byte_count * 3 / 8)
+            if len(compressed_buffer) < needed:
+                raise DungeonTruncatedError(
+                    f"Compressed data too short for {decompressed_byte_count} bytes, "
+                    f"expected at least {needed} bytes, got {len(compressed_buffer)}",
+                    'compressed_data', end_offset)
+        elif len(compressed_buffer) < 20:
+            raise DungeonTruncatedError(
+                f"Compressed data too short, expected at least 20 bytes, got {len(compressed_buffer)}",
+                'compressed_data', end_offset)
+        total_bits = (len(compressed_buffer) - 20) * 8
+        read_bits = 0
+        
         # Extract the most and less common bytes from the beginning of the compressed buffer
         most_common_bytes = compressed_buffer[:4]
         less_common_bytes = compressed_buffer[4:20]
@@ -41,19 +96,25 @@ class LoadDungeon:
         # Iterator for the compressed buffer
         buffer_iterator = iter(compressed_buffer)
         
+        exhausted = False
+        
         def get_next_byte():
             """Fetch the next byte from the compressed buffer."""
+            nonlocal exhausted
             try:
                 return next(buffer_iterator)
             except StopIteration:
-                print("No more bytes filling with 0")
+                if not exhausted:
+                    self._progress("No more bytes filling with 0")
+                    exhausted = True
                 return 0
         
         while byte_count < decompressed_byte_count:
-            # Ensure the bit buffer has at least 24 bits
+            # Ensure the bit buffer has at least 24 bits (only the low 32 bits are ever used)
             while bits_in_buffer_count <= 24:
-                bit_buffer = (bit_buffer << 8) | get_next_byte()
+                bit_buffer = ((bit_buffer << 8) | get_next_byte()) & 0xFFFFFFFF
                 bits_in_buffer_count += 8
+                read_bits += 8
             
             # Decode based on the leading 2 bits
             leading_bits = (bit_buffer >> (bits_in_buffer_count - 2)) & 3
@@ -72,6 +133,10 @@ class LoadDungeon:
                 decompressed_buffer[byte_count] = (bit_buffer >> (bits_in_buffer_count - 10)) & 255
                 bits_in_buffer_count -= 10
             
+            if strict and read_bits - bits_in_buffer_count > total_bits:
+                raise DungeonTruncatedError(
+                    f"Compressed data ended after {byte_count} of {decompressed_byte_count} bytes",
+                    'compressed_data', end_offset)
             byte_count += 1
         
         return decompressed_buffer
@@ -80,8 +145,9 @@ class LoadDungeon:
         format_string = '>HHBxHHH' + ('H' * 16)
         expected_size = struct.calcsize(format_string)
         if len(data) < expected_size:
-            print((f"Data is too short, expected at least {expected_size} bytes, got {len(data)}"))
-            raise ValueError(f"Data is too short, expected at least {expected_size} bytes, got {len(data)}")
+            raise DungeonTruncatedError(
+                f"Data is too short, expected at least {expected_size} bytes, got {len(data)}",
+                'header', len(data))
     
         # Unpack the data
         unpacked_data = struct.unpack(format_string, data)
@@ -468,16 +534,51 @@ class LoadDungeon:
 
         return explosions
 
-    def extract_dungeon_dat(self, buffer):
+    def _check_dungeon_layout(self, buffer, col):
+        # Walk the section sizes given by the header and maps and make sure the buffer holds
+        # all of them before anything is decoded. Header and maps were checked when read.
+        sections = [('columns', col*2),
+                    ('square_first_things', self.hdr['SquareFirstThingCount']*2),
+                    ('text_data', self.hdr['TextDataWordCount']*2)]
+        for i in range(16):
+            sections.append((self.THING_SECTIONS[i], self.hdr['ThingCount'][i]*self.THING_SIZES[i]))
+        sections.append(('tile_data', self.hdr['RawMapDataByteCount']))
+
+        offset = 44 + self.hdr['MapCount']*16
+        for section, size in sections:
+            if offset + size > len(buffer):
+                raise DungeonTruncatedError(
+                    f"Section needs {size} bytes, only {len(buffer) - offset} left", section, offset)
+            offset += size
+        # Anything after the tile data is read as the 2 byte checksum
+        if len(buffer) - offset == 1:
+            raise DungeonTruncatedError("Section needs 2 bytes, only 1 left", 'checksum', offset)
+
+        tile_start = offset - self.hdr['RawMapDataByteCount']
+        for map_info in self.maps:
+            map_end = map_info['RawMapDataByteOffset'] + (map_info['Width']+1) * (map_info['Height']+1)
+            if map_end > self.hdr['RawMapDataByteCount']:
+                raise DungeonFormatError(
+                    f"Map of level {map_info['Level']} ends at {map_end}, "
+                    f"beyond RawMapDataByteCount {self.hdr['RawMapDataByteCount']}",
+                    'tile_data', tile_start + map_info['RawMapDataByteOffset'])
+
+    def extract_dungeon_dat(self, buffer, strict=False):
         dungeon = BufferReader(buffer)       
-        data = dungeon.read_data(44)
+        data = dungeon.read_data(44, 'header')
         self.hdr = self._unpack_dungeon_header(data)
         # print(hdr)
         
+        # The rest of the layout needs the map widths, this bound only keeps the loop below
+        # from running over a huge MapCount
+        if strict and 44 + self.hdr['MapCount']*16 > len(buffer):
+            raise DungeonTruncatedError(
+                f"Section needs {self.hdr['MapCount']*16} bytes, only {len(buffer) - 44} left", 'maps', 44)
+
         self.maps = []
         self.mapsinfo = {}
         for i in range(self.hdr['MapCount']):
-            data = dungeon.read_data(16)
+            data = dungeon.read_data(16, 'maps')
             map_def = struct.unpack('>HHHBBHHHH', data)
             map_info = {
                 'RawMapDataByteOffset': map_def[0],
@@ -518,42 +619,47 @@ class LoadDungeon:
             # print("Level",maps[i]['Level']," Width ",maps[i]['Width'],"+1")
             col += self.maps[i]['Width']+1
 
-        print("DungeonColumnCount", col)
-        data = dungeon.read_data(col*2)
-        print("Count SFTC: ",self.hdr['SquareFirstThingCount']*2)
-        data = dungeon.read_data(self.hdr['SquareFirstThingCount']*2)
-        print("Count TextDataWordCount: ",self.hdr['TextDataWordCount']*2)
-        data = dungeon.read_data(self.hdr['TextDataWordCount']*2)
+        if strict:
+            self._check_dungeon_layout(buffer, col)
+
+        self._progress("DungeonColumnCount", col)
+        data = dungeon.read_data(col*2, 'columns')
+        self.columnlist = struct.unpack(f'>{col}H', data)
+        self._progress("Count SFTC: ",self.hdr['SquareFirstThingCount']*2)
+        data = dungeon.read_data(self.hdr['SquareFirstThingCount']*2, 'square_first_things')
+        self.squarefirstthinglist = struct.unpack(f">{self.hdr['SquareFirstThingCount']}H", data)
+        self._progress("Count TextDataWordCount: ",self.hdr['TextDataWordCount']*2)
+        data = dungeon.read_data(self.hdr['TextDataWordCount']*2, 'text_data')
         # print("hdr", hdr)
-        print("Starting ThingCount (16): ", dungeon.position)
-        data = dungeon.read_data(self.hdr['ThingCount'][0]*4)  #         4,   /* Door */
+        self._progress("Starting ThingCount (16): ", dungeon.position)
+        data = dungeon.read_data(self.hdr['ThingCount'][0]*4, 'doors')  #         4,   /* Door */
         self.doorlist = self.decode_doorlist(data)
-        data = dungeon.read_data(self.hdr['ThingCount'][1]*6)  #         6,   /* Teleporter */
+        data = dungeon.read_data(self.hdr['ThingCount'][1]*6, 'teleporters')  #         6,   /* Teleporter */
         self.teleporterlist = self.decode_teleporterlist(data)
-        data = dungeon.read_data(self.hdr['ThingCount'][2]*4)  #         4,   /* Text String */
+        data = dungeon.read_data(self.hdr['ThingCount'][2]*4, 'textstrings')  #         4,   /* Text String */
         self.textstringlist = self.decode_textstringlist(data)
-        data = dungeon.read_data(self.hdr['ThingCount'][3]*8)  #         8,   /* Sensor */
+        data = dungeon.read_data(self.hdr['ThingCount'][3]*8, 'sensors')  #         8,   /* Sensor */
         self.sensorlist = self.decode_sensorlist(data)
-        data = dungeon.read_data(self.hdr['ThingCount'][4]*16) #         16,  /* Creature (Group) */
+        data = dungeon.read_data(self.hdr['ThingCount'][4]*16, 'creatures') #         16,  /* Creature (Group) */
         self.creaturelist = self.decode_creaturelist(data)
-        data = dungeon.read_data(self.hdr['ThingCount'][5]*4)  #         4,   /* Weapon */
+        data = dungeon.read_data(self.hdr['ThingCount'][5]*4, 'weapons')  #         4,   /* Weapon */
         self.weaponlist = self.decode_weaponlist(data)
-        data = dungeon.read_data(self.hdr['ThingCount'][6]*4)  #         4,   /* Armour */
+        data = dungeon.read_data(self.hdr['ThingCount'][6]*4, 'armors')  #         4,   /* Armour */
         self.armorlist = self.decode_armorlist(data)
-        data = dungeon.read_data(self.hdr['ThingCount'][7]*4)  #         4,   /* Scroll */
+        data = dungeon.read_data(self.hdr['ThingCount'][7]*4, 'scrolls')  #         4,   /* Scroll */
         self.scrolllist = self.decode_scrolllist(data)
-        data = dungeon.read_data(self.hdr['ThingCount'][8]*4)  #         4,   /* Potion */
+        data = dungeon.read_data(self.hdr['ThingCount'][8]*4, 'potions')  #         4,   /* Potion */
         self.potionlist = self.decode_potionlist(data)
-        data = dungeon.read_data(self.hdr['ThingCount'][9]*8)  #         8,   /* Container */
+        data = dungeon.read_data(self.hdr['ThingCount'][9]*8, 'containers')  #         8,   /* Container */
         self.containerlist = self.decode_containerlist(data)
-        data = dungeon.read_data(self.hdr['ThingCount'][10]*4) #         4,   /* Junk */
+        data = dungeon.read_data(self.hdr['ThingCount'][10]*4, 'junk') #         4,   /* Junk */
         self.junklist = self.decode_junklist(data)
-        data = dungeon.read_data(self.hdr['ThingCount'][11]*0) #         0,   /* Unused */
-        data = dungeon.read_data(self.hdr['ThingCount'][12]*0) #         0,   /* Unused */
-        data = dungeon.read_data(self.hdr['ThingCount'][13]*0) #         0,   /* Unused */
-        data = dungeon.read_data(self.hdr['ThingCount'][14]*8) #         8,   /* Projectile */
+        data = dungeon.read_data(self.hdr['ThingCount'][11]*0, 'unused11') #         0,   /* Unused */
+        data = dungeon.read_data(self.hdr['ThingCount'][12]*0, 'unused12') #         0,   /* Unused */
+        data = dungeon.read_data(self.hdr['ThingCount'][13]*0, 'unused13') #         0,   /* Unused */
+        data = dungeon.read_data(self.hdr['ThingCount'][14]*8, 'projectiles') #         8,   /* Projectile */
         self.projectilelist = self.decode_projectilelist(data)
-        data = dungeon.read_data(self.hdr['ThingCount'][15]*4) #         4    /* Explosion */
+        data = dungeon.read_data(self.hdr['ThingCount'][15]*4, 'explosions') #         4    /* Explosion */
         self.explosionlist = self.decode_explosionlist(data)
         
         self.thinglist = []
@@ -574,14 +680,14 @@ class LoadDungeon:
         self.thinglist.append(self.projectilelist)
         self.thinglist.append(self.explosionlist)
         
-        print("Reading Tilebuffer: ", self.hdr['RawMapDataByteCount'])
-        self.tile_data = dungeon.read_data(self.hdr['RawMapDataByteCount'])
+        self._progress("Reading Tilebuffer: ", self.hdr['RawMapDataByteCount'])
+        self.tile_data = dungeon.read_data(self.hdr['RawMapDataByteCount'], 'tile_data')
 
         if (len(buffer)- dungeon.position) > 0:
-            print("Reading Chcksum: 2")
-            self.chksum    = dungeon.read_data(2)
+            self._progress("Reading Chcksum: 2")
+            self.chksum    = dungeon.read_data(2, 'checksum')
             
-        print("Ending Data: ", dungeon.position, "Len of Buffer", len(buffer), " read.")
+        self._progress("Ending Data: ", dungeon.position, "Len of Buffer", len(buffer), " read.")
         dungeon_dat = {
             'header':       self.hdr,
             'maps_info':    self.mapsinfo,
@@ -590,6 +696,46 @@ class LoadDungeon:
         }
         return dungeon_dat
 
+    def get_square_things(self, map_index, x, y):
+        # Follow the thing list of one square: the column table gives the index of the first
+        # square with things in column x, counting the flagged squares above y gives ours
+        map_info = self.maps[map_index]
+        w = (map_info['Width']+1)
+        h = (map_info['Height']+1)
+        if not (0 <= x < w and 0 <= y < h):
+            raise IndexError(f"Square {x},{y} outside of map {map_index} ({w}x{h})")
+        column_start = map_info['RawMapDataByteOffset'] + (x * h)
+        if not self.tile_data[column_start + y] & 0x10:
+            return []
+        column = x
+        for i in range(map_index):
+            column += self.maps[i]['Width']+1
+        index = self.columnlist[column]
+        for square in self.tile_data[column_start:column_start + y]:
+            if square & 0x10:
+                index += 1
+
+        things = []
+        thing = self.squarefirstthinglist[index]
+        max_things = sum(len(things_of_type) for things_of_type in self.thinglist if things_of_type)
+        while thing not in (0xFFFE, 0xFFFF) and len(things) < max_things:
+            # THING: Cell (2 bits), Type (4 bits), Index (10 bits)
+            thing_type = (thing >> 10) & 0xF
+            thing_index = thing & 0x3FF
+            things_of_type = self.thinglist[thing_type]
+            if not things_of_type or thing_index >= len(things_of_type):
+                break
+            data = things_of_type[thing_index]
+            things.append({
+                'Thing': thing,
+                'Cell': thing >> 14,
+                'Type': thing_type,
+                'Index': thing_index,
+                'Data': data,
+            })
+            thing = data['Next']
+        return things
+
     def _dbg_print_dungeon(self, level):
         map_info = self.maps[level]
         txtmap= ""
@@ -663,24 +809,42 @@ class LoadDungeon:
         print("MapData ----------------")
         print(txtmap)
 
-    def load(self, filename):
+    def load(self, filename, strict=False, verbose=None):
         with open(filename, 'rb') as file:
             buffer = file.read()
-            header_format = '>HlH'
-            header_size = struct.calcsize(header_format)
-            header_data = buffer[:header_size]
-            signature, decompressed_byte_count, dungeon_id = struct.unpack(header_format, header_data)
-            if signature == 0x8104:
-                print("Compressed Dungeon.dat: uncompressing")
-                buffer = self.decompress_dungeon(buffer[8:], decompressed_byte_count)
-                return self.extract_dungeon_dat(buffer)
-            elif signature == 0x0481:
-                print("Compressed Dungeon.dat: Little Endian not supported at the moment.")
-            elif buffer[1] == 0x00:
-                print("Normal Dungeon.dat: Little Endian not supported at the moment.")
-            elif buffer[1] == 0x63:
-                print("Normal Dungeon.dat: extracting Data")
-                return self.extract_dungeon_dat(buffer)
-            else:
-                print("Not a recognized Dungeon.dat file.")        
+        return self.load_buffer(buffer, strict, verbose)
+
+    def load_buffer(self, buffer, strict=False, verbose=None):
+        # With strict=True (for untrusted uploads) every problem raises a DungeonFormatError
+        # or DungeonTruncatedError carrying the section and offset, and nothing is printed
+        # unless verbose=True is given
+        self.verbose = not strict if verbose is None else verbose
+        header_format = '>HlH'
+        header_size = struct.calcsize(header_format)
+        if len(buffer) < header_size:
+            raise DungeonTruncatedError(
+                f"File is too short, expected at least {header_size} bytes, got {len(buffer)}",
+                'file_header', len(buffer))
+        header_data = buffer[:header_size]
+        signature, decompressed_byte_count, dungeon_id = struct.unpack(header_format, header_data)
+        if signature == 0x8104:
+            self._progress("Compressed Dungeon.dat: uncompressing")
+            buffer = self.decompress_dungeon(buffer[8:], decompressed_byte_count, strict)
+            try:
+                return self.extract_dungeon_dat(buffer, strict)
+            except DungeonFormatError as error:
+                error.decompressed = True
+                raise
+        elif signature == 0x0481:
+            message = "Compressed Dungeon.dat: Little Endian not supported at the moment."
+        elif buffer[1] == 0x00:
+            message = "Normal Dungeon.dat: Little Endian not supported at the moment."
+        elif buffer[1] == 0x63:
+            self._progress("Normal Dungeon.dat: extracting Data")
+            return self.extract_dungeon_dat(buffer, strict)
+        else:
+            message = "Not a recognized Dungeon.dat file."
+        if strict:
+            raise DungeonFormatError(message, 'file_header', 0)
+        self._progress(message)
         return None